@@ -0,0 +1,78 @@
+"""
+Benchmark Cluster membership updates as the Cluster grows.
+
+Measures the per-operation cost of adding new Nodes, re-announcing existing
+Nodes (what heartbeat-driven NodeActive messages do) and removing Nodes, for
+Clusters of 10 up to 50,000 Nodes.
+
+Run with the MDK installed into the current Python environment:
+
+    python benchmarks/cluster_membership.py
+"""
+
+from __future__ import print_function
+
+from time import time
+
+from mdk_discovery import Cluster, Node, RecordingFailurePolicyFactory
+
+SIZES = [10, 100, 1000, 2000, 10000, 50000]
+# Number of operations timed for each measurement:
+OPERATIONS = 2000
+
+
+def create_node(idx):
+    """Create a Node with a unique id and address."""
+    node = Node()
+    node.id = "node-%d" % (idx,)
+    node.service = "benchmark"
+    node.version = "1.0"
+    node.address = "10.0.%d.%d:8080" % (idx // 256, idx % 256)
+    return node
+
+
+def populated_cluster(size):
+    """Create a Cluster with the given number of Nodes."""
+    cluster = Cluster(RecordingFailurePolicyFactory())
+    for idx in range(size):
+        cluster.add(create_node(idx))
+    return cluster
+
+
+def per_operation(function, operations):
+    """Return microseconds per call of function(idx) for idx in operations."""
+    start = time()
+    for idx in operations:
+        function(idx)
+    return (time() - start) * 1e6 / len(operations)
+
+
+def measure(size):
+    """Return (add, update, remove) microseconds per operation."""
+    count = min(OPERATIONS, size)
+
+    cluster = populated_cluster(size)
+    add = per_operation(lambda idx: cluster.add(create_node(size + idx)),
+                        range(count))
+
+    cluster = populated_cluster(size)
+    heartbeats = [create_node(idx) for idx in range(0, size, size // count)]
+    update = per_operation(lambda idx: cluster.add(heartbeats[idx]),
+                           range(len(heartbeats)))
+
+    cluster = populated_cluster(size)
+    removals = [create_node(idx) for idx in range(0, size, size // count)]
+    remove = per_operation(lambda idx: cluster.remove(removals[idx]),
+                           range(len(removals)))
+    return add, update, remove
+
+
+def main():
+    print("%8s %12s %12s %12s" % ("nodes", "add (us)", "update (us)",
+                                  "remove (us)"))
+    for size in SIZES:
+        print("%8d %12.2f %12.2f %12.2f" % ((size,) + measure(size)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""
+Benchmark Discovery.resolve() throughput while discovery updates arrive.
+
+N reader threads resolve a service in a loop while one writer thread sends a
+stream of NodeActive (heartbeat) messages and the occasional ReplaceCluster to
+the same Discovery instance. Resolve throughput is reported with and without
+the writer running.
+
+Run with the MDK installed into the current Python environment:
+
+    python benchmarks/discovery_contention.py
+"""
+
+from __future__ import print_function
+
+from threading import Thread, Event
+from time import time, sleep
+
+from mdk_runtime import fakeRuntime
+from mdk_discovery import (
+    Discovery, Node, NodeActive, ReplaceCluster, RecordingFailurePolicyFactory,
+)
+from mdk import _parseEnvironment
+
+READERS = [1, 4, 16, 64]
+NODES = 1000
+DURATION = 2.0
+ENVIRONMENT = _parseEnvironment("sandbox")
+
+
+def create_node(idx):
+    """Create a Node with a unique id and address."""
+    node = Node()
+    node.id = "node-%d" % (idx,)
+    node.service = "benchmark"
+    node.version = "1.0"
+    node.address = "10.0.%d.%d:8080" % (idx // 256, idx % 256)
+    node.environment = ENVIRONMENT
+    return node
+
+
+def create_disco():
+    """Create a Discovery with NODES Nodes for the benchmark service."""
+    runtime = fakeRuntime()
+    runtime.dependencies.registerService(
+        "failurepolicy_factory", RecordingFailurePolicyFactory())
+    disco = Discovery(runtime)
+    disco.onStart(runtime.dispatcher)
+    disco.onMessage(None, ReplaceCluster(
+        "benchmark", ENVIRONMENT, [create_node(i) for i in range(NODES)]))
+    return disco
+
+
+def reader(disco, stop, counts, idx):
+    """Resolve until told to stop, recording how many resolves were done."""
+    count = 0
+    while not stop.is_set():
+        disco.resolve("benchmark", "1.0", ENVIRONMENT)
+        count += 1
+    counts[idx] = count
+
+
+def writer(disco, stop):
+    """Send heartbeats, and every so often replace the whole cluster."""
+    idx = 0
+    while not stop.is_set():
+        if idx % 1000 == 999:
+            disco.onMessage(None, ReplaceCluster(
+                "benchmark", ENVIRONMENT,
+                [create_node(i) for i in range(NODES)]))
+        else:
+            disco.onMessage(None, NodeActive(create_node(idx % NODES)))
+        idx += 1
+
+
+def measure(readers, with_writer):
+    """Return resolves per second for the given number of reader threads."""
+    disco = create_disco()
+    stop = Event()
+    counts = [0] * readers
+    threads = [Thread(target=reader, args=(disco, stop, counts, i))
+               for i in range(readers)]
+    if with_writer:
+        threads.append(Thread(target=writer, args=(disco, stop)))
+    start = time()
+    for thread in threads:
+        thread.start()
+    sleep(DURATION)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / (time() - start)
+
+
+def main():
+    print("%8s %18s %18s" % ("readers", "resolves/s", "with writer"))
+    for readers in READERS:
+        print("%8d %18.0f %18.0f" % (readers, measure(readers, False),
+                                     measure(readers, True)))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,28 +1,98 @@
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import logging
 import os
+import stat
+import struct
+import sys
 import tempfile
+import threading
+import time
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 """
 TODO: This is all semi-broken since in Python quark.String is not Unicode
 all the time.
 """
 
-__all__ = ["_mdk_mktempdir", "_mdk_writefile", "_mdk_deletefile",
-           "_mdk_file_contents", "_mdk_readfile"]
+__all__ = ["_mdk_mktempdir", "_mdk_writefile", "_mdk_try_writefile",
+           "_mdk_deletefile",
+           "_mdk_file_contents", "_mdk_readfile", "_mdk_readfile_if_exists",
+           "_mdk_hash", "_mdk_watch", "_mdk_thread_pool", "_mdk_call_logged"]
+
+# The process umask, which can only be read by changing it, so that's done
+# once before any threads are started:
+_UMASK = os.umask(0o022)
+os.umask(_UMASK)
 
 def _mdk_mktempdir():
     """Create temporary directory."""
     return tempfile.mkdtemp()
 
 def _mdk_writefile(path, contents):
-    """Write a file to disk."""
-    with open(path, "wb") as f:
-        f.write(contents.encode("utf-8"))
+    """
+    Write a file to disk.
+
+    The contents are written to a temporary file which is then renamed, so
+    readers never see a partially written file. The file keeps its mode if it
+    already exists, otherwise it gets the mode a newly created file would.
+    """
+    directory, name = os.path.split(path)
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = 0o666 & ~_UMASK
+    fd, temp_path = tempfile.mkstemp(prefix="." + name, dir=directory or ".")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            os.fchmod(f.fileno(), mode)
+            f.write(contents.encode("utf-8"))
+        os.rename(temp_path, path)
+    except Exception:
+        os.remove(temp_path)
+        raise
+
+def _mdk_try_writefile(path, contents):
+    """Write a file to disk, logging rather than raising any failure."""
+    try:
+        _mdk_writefile(path, contents)
+    except Exception:
+        logging.getLogger("mdk_runtime_files").exception(
+            "Failure writing %s", path)
 
 def _mdk_readfile(path):
     """Read a file's contents."""
     with open(path, "rb") as f:
         return f.read().decode("utf-8")
 
+def _mdk_readfile_if_exists(path):
+    """
+    Read a file's contents, or return None if it doesn't exist or isn't
+    valid UTF-8.
+    """
+    try:
+        return _mdk_readfile(path)
+    except (IOError, OSError):
+        return None
+    except UnicodeDecodeError:
+        logging.getLogger("mdk_runtime_files").warning(
+            "Ignoring %s, which isn't valid UTF-8", path)
+        return None
+
+def _mdk_call_logged(work):
+    """Call a Quark callable with None, logging rather than raising any failure."""
+    try:
+        work(None)
+    except Exception:
+        logging.getLogger("mdk_runtime_files").exception(
+            "Failure running file I/O")
+
 def _mdk_deletefile(path):
     """Delete a file."""
     os.remove(path)
@@ -33,3 +103,229 @@ def _mdk_file_contents(path):
         return [os.path.join(path, name) for name in os.listdir(path)]
     else:
         return [path]
+
+def _mdk_hash(contents):
+    """Return a hash of a file's contents."""
+    return hashlib.sha1(contents.encode("utf-8")).hexdigest()
+
+
+class _StatWatcher(object):
+    """
+    Find files that may have changed by comparing their modification time,
+    size and inode with the previous check.
+
+    If a directory's own modification time hasn't changed no entries were
+    added or removed, so only the files already known about are checked and
+    the directory isn't listed again.
+    """
+    # Directory modification times may have coarse granularity, so a listing
+    # made less than this many seconds after the modification time may have
+    # missed a change made within the same tick:
+    RACY_SECONDS = 2.0
+
+    def __init__(self, path):
+        self.path = path
+        self.stats = {}
+        self.directory = None
+        self.listed_at = 0.0
+
+    def _directory_unchanged(self):
+        """
+        Return whether the directory is known not to have gained or lost
+        entries since it was last listed.
+        """
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.directory = None
+            return False
+        previous = self.directory
+        self.directory = (stat.st_mtime, stat.st_ino)
+        if previous != self.directory or not os.path.isdir(self.path):
+            return False
+        return stat.st_mtime < self.listed_at - self.RACY_SECONDS
+
+    def changed(self):
+        """
+        Return paths that were created, modified or deleted since last call.
+        """
+        if self._directory_unchanged():
+            paths = list(self.stats)
+        else:
+            self.listed_at = time.time()
+            paths = _mdk_file_contents(self.path)
+        current = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            current[path] = (stat.st_mtime, stat.st_size, stat.st_ino)
+        result = [path for path, stat in current.items()
+                  if self.stats.get(path) != stat]
+        result.extend(path for path in self.stats if path not in current)
+        self.stats = current
+        return result
+
+    def close(self):
+        pass
+
+
+# From <sys/inotify.h>:
+_IN_MODIFY = 0x00000002
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_NONBLOCK = os.O_NONBLOCK
+_IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct("iIII")
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM |
+               _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF |
+               _IN_MOVE_SELF)
+
+
+class _InotifyWatcher(object):
+    """
+    Find files that may have changed using Linux's inotify, so that checking
+    for changes costs a single non-blocking read.
+
+    A file is watched via its parent directory, so it's still noticed if
+    it's replaced by renaming another file over it.
+    """
+    def __init__(self, libc, path):
+        self.path = path
+        if os.path.isdir(path):
+            self.directory, self.name = path, None
+        else:
+            self.directory, self.name = os.path.split(path)
+        self.fd = libc.inotify_init1(_IN_NONBLOCK | _IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(self.fd, self.directory.encode("utf-8"),
+                                    _WATCH_MASK)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        self.started = False
+        # Used instead once the inotify watch stops working:
+        self.fallback = None
+
+    def _read(self):
+        """Return the pending inotify events' data."""
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def changed(self):
+        """
+        Return paths that were created, modified or deleted since last call,
+        or None if that is unknown and everything should be checked.
+        """
+        if self.fallback is not None:
+            return self.fallback.changed()
+        if not self.started:
+            self.started = True
+            return None
+        data = self._read()
+        result = []
+        seen = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode("utf-8")
+            offset += length
+            if mask & (_IN_Q_OVERFLOW | _IN_IGNORED | _IN_DELETE_SELF |
+                       _IN_MOVE_SELF):
+                # Events were lost or the directory went away, so the watch
+                # can't be trusted any more:
+                os.close(self.fd)
+                self.fd = None
+                self.fallback = _StatWatcher(self.path)
+                self.fallback.changed()
+                return None
+            if not name or (self.name is not None and name != self.name):
+                continue
+            path = os.path.join(self.directory, name)
+            if path not in seen:
+                seen.add(path)
+                result.append(path)
+        return result
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _mdk_watch(path):
+    """
+    Return an object whose changed() method returns paths under the given
+    file or directory path that may have changed since its previous call, or
+    None if everything should be checked, as on the first call.
+
+    Uses inotify where available, otherwise file modification times and
+    sizes.
+    """
+    if sys.platform.startswith("linux") and os.path.exists(path):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                               use_errno=True)
+            return _InotifyWatcher(libc, path)
+        except (OSError, AttributeError):
+            pass
+    return _StatWatcher(path)
+
+
+class _ThreadPool(object):
+    """
+    A fixed number of daemon worker threads running submitted callables.
+
+    Threads are only started when work is first submitted.
+    """
+    def __init__(self, workers):
+        self._workers = workers
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._started = False
+
+    def _run(self):
+        while True:
+            work = self._queue.get()
+            try:
+                work(None)
+            except Exception:
+                logging.getLogger("mdk_runtime_files").exception(
+                    "Failure running file I/O")
+
+    def submit(self, work):
+        """Run the Quark callable in a worker thread, passing it None."""
+        with self._lock:
+            if not self._started:
+                self._started = True
+                for _ in range(self._workers):
+                    thread = threading.Thread(target=self._run,
+                                              name="mdk-file-io")
+                    thread.daemon = True
+                    thread.start()
+        self._queue.put(work)
+
+def _mdk_thread_pool(workers):
+    """Create a pool of worker threads for file I/O."""
+    return _ThreadPool(workers)
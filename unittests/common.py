@@ -95,10 +95,19 @@ class MDKConnector(object):
         return actor
 
     def expectSerializable(self, fake_wsactor, expected_type):
-        """Return the last sent message of given type."""
-        msg = fake_wsactor.expectTextMessage()
-        assert msg is not None
-        json = loads(msg)
+        """
+        Return the last sent message of given type.
+
+        Discovery interest declarations can be sent at any point, so they're
+        skipped unless they're the expected type.
+        """
+        while True:
+            msg = fake_wsactor.expectTextMessage()
+            assert msg is not None
+            json = loads(msg)
+            if (json["type"] != "interest" or
+                expected_type == "mdk_discovery.protocol.Interest"):
+                break
         evt = Serializable.decodeClassName(expected_type, msg)
         assert json["type"] == evt._json_type
         return evt
@@ -7,7 +7,9 @@ from builtins import range
 from builtins import object
 
 from unittest import TestCase
-from json import dumps
+from json import dumps, loads
+import os
+import stat
 from uuid import uuid4
 
 from hypothesis.stateful import GenericStateMachine
@@ -16,10 +18,14 @@ from hypothesis import strategies as st
 from .common import fake_runtime, SANDBOX_ENV, create_node, MDKConnector
 
 from mdk_discovery import (
-    Discovery, NodeActive, NodeExpired, ReplaceCluster,
-    CircuitBreakerFactory, StaticRoutes, Node,
+    Discovery, NodeActive, NodeExpired, ReplaceCluster, NodeBatch,
+    CircuitBreakerFactory, FailureRatePolicyFactory, StaticRoutes, Node, Cluster,
+    RecordingFailurePolicyFactory, LeastOutstanding, LeastLatency, PeakEWMA,
+    ResolveTimeout, UnknownService, SyncComplete, OutlierDetectorFactory,
+    CompositeSourceFactory, DiscoverySource, DiscoverySourceFactory, RegisterNode,
+    TimerWheel, RemoveInterest,
 )
-from mdk_discovery.protocol import Active
+from mdk_discovery.protocol import Active, Expire, Interest
 from mdk import _parseEnvironment
 
 
@@ -44,6 +50,41 @@ def knownNodes(disco, service, environment="sandbox"):
     return disco.knownNodes(service, _parseEnvironment(environment))
 
 
+def advance(disco, seconds):
+    """Move a Discovery's time forward and deliver any scheduled events."""
+    disco.runtime.dispatcher.pump()
+    time = disco.runtime.getTimeService()
+    time.advance(seconds)
+    time.pump()
+    disco.runtime.dispatcher.pump()
+
+
+def create_cluster(addresses, policy_factory=None):
+    """Create a Cluster with Nodes at the given addresses, returning both."""
+    if policy_factory is None:
+        policy_factory = RecordingFailurePolicyFactory()
+    cluster = Cluster(policy_factory)
+    nodes = [create_node(address) for address in addresses]
+    for node in nodes:
+        cluster.add(node)
+    return cluster, nodes
+
+
+def create_outlier_cluster(addresses, make_policy_factory=None):
+    """
+    Create a Cluster with an OutlierDetector and a fake clock, returning the
+    clock and the Cluster. make_policy_factory, if given, is called with the
+    runtime to create the Cluster's FailurePolicyFactory.
+    """
+    runtime = fake_runtime()
+    policy_factory = None
+    if make_policy_factory is not None:
+        policy_factory = make_policy_factory(runtime)
+    cluster, _ = create_cluster(addresses, policy_factory)
+    cluster.withOutlierDetector(OutlierDetectorFactory(runtime).create())
+    return runtime.getTimeService(), cluster
+
+
 class NodeTests(TestCase):
     """Tests for Node."""
     def test_id(self):
@@ -59,6 +100,477 @@ class NodeTests(TestCase):
         self.assertEqual(node.getId(), "4567")
 
 
+class ClusterTests(TestCase):
+    """Tests for Cluster."""
+
+    def test_updateKeepsPosition(self):
+        """
+        Updating a Node with the same address or id replaces it in place.
+        """
+        cluster, [a, b, c] = create_cluster(["a", "b", "c"])
+        by_address = create_node("b")
+        cluster.add(by_address)
+        by_id = create_node("c2")
+        by_id.id = c.id
+        cluster.add(by_id)
+        self.assertEqual(cluster.nodes, [a, by_address, by_id])
+
+    def test_removeMiddle(self):
+        """
+        Removing a Node leaves the remaining Nodes in the Cluster and they can
+        still be found for updates and removal.
+        """
+        cluster, [a, b, c, d] = create_cluster(["a", "b", "c", "d"])
+        cluster.remove(b)
+        self.assertEqual(set(cluster.nodes), set([a, c, d]))
+        d2 = create_node("d")
+        cluster.add(d2)
+        self.assertEqual(set(cluster.nodes), set([a, c, d2]))
+        cluster.remove(d2)
+        cluster.remove(a)
+        self.assertEqual(cluster.nodes, [c])
+
+    def test_removeKeepsOrder(self):
+        """
+        Removing a Node keeps the round robin order of the remaining Nodes.
+        """
+        cluster, [a, b, c, d] = create_cluster(["a", "b", "c", "d"])
+        self.assertEqual(cluster.choose().address, "a")
+        cluster.remove(b)
+        self.assertEqual(cluster.nodes, [a, c, d])
+        chosen = [cluster.choose().address for i in range(3)]
+        self.assertEqual(chosen, ["c", "d", "a"])
+        # The shifted Nodes can still be updated and removed:
+        c2 = create_node("c")
+        cluster.add(c2)
+        cluster.remove(d)
+        self.assertEqual(cluster.nodes, [a, c2])
+
+    def test_stateNotModified(self):
+        """
+        Changing the Cluster publishes a new state for choosing Nodes rather
+        than modifying the one readers may be using.
+        """
+        cluster, [a, b] = create_cluster(["a", "b"])
+        state = cluster._current()
+        cluster.remove(a)
+        cluster.add(create_node("c"))
+        self.assertEqual(state.addresses, ["a", "b"])
+        self.assertEqual(cluster._current().addresses, ["b", "c"])
+
+    def test_nodeIdProperty(self):
+        """
+        Nodes identified only by the datawire_nodeId property are updated in
+        place.
+        """
+        cluster = Cluster(RecordingFailurePolicyFactory())
+        a = create_node("a")
+        a.id = None
+        a.properties["datawire_nodeId"] = "1234"
+        cluster.add(a)
+        a2 = create_node("a2")
+        a2.id = None
+        a2.properties["datawire_nodeId"] = "1234"
+        cluster.add(a2)
+        self.assertEqual(cluster.nodes, [a2])
+        cluster.remove(a2)
+        self.assertEqual(cluster.nodes, [])
+
+    def test_updateMatchesTwo(self):
+        """
+        An update with the id of one Node and the address of another replaces
+        both, and the Cluster's indexes stay consistent.
+        """
+        cluster, [a, b, c] = create_cluster(["a", "b", "c"])
+        update = create_node("c")
+        update.id = a.id
+        cluster.add(update)
+        self.assertEqual(cluster.nodes, [update, b])
+        self.assertIs(cluster._node("c"), update)
+        cluster.remove(update)
+        self.assertEqual(cluster.nodes, [b])
+        self.assertEqual(cluster._node("c"), None)
+
+    def test_removeUnknown(self):
+        """Removing a Node that isn't in the Cluster does nothing."""
+        cluster, nodes = create_cluster(["a", "b"])
+        cluster.remove(create_node("c"))
+        self.assertEqual(cluster.nodes, nodes)
+
+    def test_removeWithoutId(self):
+        """
+        Nodes without an id are removed by address, leaving the other Nodes.
+        """
+        a, b, c = [create_node(address) for address in ["a", "b", "c"]]
+        b.id = None
+        cluster = Cluster(RecordingFailurePolicyFactory())
+        for node in [a, b, c]:
+            cluster.add(node)
+        cluster.remove(b)
+        self.assertEqual(cluster.nodes, [a, c])
+        self.assertEqual(cluster._node("b"), None)
+
+    def test_roundRobin(self):
+        """Nodes are chosen in round robin order."""
+        cluster, nodes = create_cluster(["a", "b", "c"])
+        chosen = [cluster.choose().address for i in range(6)]
+        self.assertEqual(chosen, ["a", "b", "c", "a", "b", "c"])
+
+    def test_replace(self):
+        """
+        replace() removes Nodes that are missing, adds new and changed Nodes and
+        keeps unchanged Nodes.
+        """
+        cluster, [a, b, c] = create_cluster(["a", "b", "c"])
+        b2 = create_node("b")
+        b2.id = b.id
+        b2.version = "1.1"
+        d = create_node("d")
+        self.assertTrue(cluster.replace([create_node("a"), b2, d]))
+        self.assertEqual(set(cluster.nodes), set([cluster._node("a"), b2, d]))
+
+        a2 = create_node("a")
+        a2.id = a.id
+        self.assertTrue(cluster.replace([a2, b2, d]))
+        self.assertEqual(set(cluster.nodes), set([a2, b2, d]))
+
+    def test_replaceUnchanged(self):
+        """
+        replace() with the same Nodes doesn't change anything, and the existing
+        Node objects are kept.
+        """
+        cluster, nodes = create_cluster(["a", "b"])
+        copies = []
+        for node in nodes:
+            copy = create_node(node.address)
+            copy.id = node.id
+            copies.append(copy)
+        self.assertFalse(cluster.replace(copies))
+        self.assertEqual(cluster.nodes, nodes)
+        self.assertIs(cluster.nodes[0], nodes[0])
+
+    def test_replaceWithoutId(self):
+        """
+        replace() removes missing Nodes that have no id.
+        """
+        a, b = create_node("a"), create_node("b")
+        b.id = None
+        cluster = Cluster(RecordingFailurePolicyFactory())
+        cluster.add(a)
+        cluster.add(b)
+        self.assertTrue(cluster.replace([a]))
+        self.assertEqual(cluster.nodes, [a])
+        self.assertEqual(cluster._node("b"), None)
+
+    def test_expireStaleWithoutId(self):
+        """
+        Expiring stale Nodes removes those that have no id.
+        """
+        a, b = create_node("a"), create_node("b")
+        b.id = None
+        cluster = Cluster(RecordingFailurePolicyFactory())
+        cluster.add(a)
+        cluster._addStale(b)
+        self.assertEqual(cluster._expireStale(), 1)
+        self.assertEqual(cluster.nodes, [a])
+        self.assertFalse(cluster.isStale("b"))
+
+    def test_chooseVersion(self):
+        """Only Nodes with a compatible version are chosen."""
+        cluster = Cluster(RecordingFailurePolicyFactory())
+        for address, version in [("a", "1.0"), ("b", "2.0"), ("c", "1.2"),
+                                 ("d", "2.1")]:
+            node = create_node(address)
+            node.version = version
+            cluster.add(node)
+        self.assertEqual(
+            [cluster.chooseVersion("1.1").address for i in range(3)],
+            ["c", "c", "c"])
+        self.assertEqual(
+            set(cluster.chooseVersion("2.0").address for i in range(4)),
+            set(["b", "d"]))
+        self.assertEqual(cluster.chooseVersion("3.0"), None)
+
+    def test_versionChange(self):
+        """Updating a Node with a new version moves it to the new version."""
+        cluster, [a, b] = create_cluster(["a", "b"])
+        b2 = create_node("b")
+        b2.id = b.id
+        b2.version = "2.0"
+        cluster.add(b2)
+        self.assertEqual(
+            [cluster.chooseVersion("1.0").address for i in range(2)],
+            ["a", "a"])
+        self.assertEqual(cluster.chooseVersion("2.0").address, "b")
+
+    def test_leastOutstanding(self):
+        """
+        With LeastOutstanding the Node with fewer requests in flight is chosen
+        when there are two Nodes.
+        """
+        cluster, nodes = create_cluster(["a", "b"])
+        cluster.withBalancer(LeastOutstanding())
+        busy = cluster.choose()
+        busy._started()
+        other = [cluster.choose().address for i in range(5)]
+        self.assertEqual(set(other), set(["a", "b"]) - set([busy.address]))
+        busy._finished()
+        chosen = [cluster.choose().address for i in range(20)]
+        self.assertEqual(set(chosen), set(["a", "b"]))
+
+    def test_leastOutstandingSeeds(self):
+        """
+        Each LeastOutstanding instance is seeded differently, so separate
+        instances don't make the same sequence of choices.
+        """
+        first, second = LeastOutstanding(), LeastOutstanding()
+        self.assertNotEqual(first._seed, second._seed)
+        for balancer in (first, second):
+            self.assertTrue(1 <= balancer._seed <= 2147483646)
+
+    def test_leastLatency(self):
+        """
+        With LeastLatency the Node with lower latency is chosen when there are
+        two Nodes.
+        """
+        cluster, nodes = create_cluster(["a", "b"])
+        cluster.withBalancer(LeastLatency())
+        cluster._observeLatency("a", 100.0, 0.0)
+        cluster._observeLatency("b", 10.0, 0.0)
+        chosen = [cluster.choose().address for i in range(5)]
+        self.assertEqual(chosen, ["b"] * 5)
+
+    def test_latencyFromNode(self):
+        """Latency recorded by a chosen Node is stored in the Cluster."""
+        cluster, nodes = create_cluster(["a"])
+        cluster.choose()._observeLatency(25.0, 0.0)
+        self.assertEqual(cluster.latency("a"), 25.0)
+        self.assertEqual(cluster.latency("unknown"), 0.0)
+
+    def create_breaker_cluster(self, *addresses):
+        """Create a Cluster using circuit breakers and a fake clock."""
+        runtime = fake_runtime()
+        cluster = Cluster(CircuitBreakerFactory(runtime))
+        for address in addresses:
+            cluster.add(create_node(address))
+        return runtime.getTimeService(), cluster
+
+    def test_unavailableSkipped(self):
+        """Nodes whose circuit breaker has tripped are not chosen."""
+        time, cluster = self.create_breaker_cluster("a", "b", "c")
+        cluster.choose()
+        b = cluster.choose()
+        for i in range(3):
+            b.failure()
+        chosen = [cluster.choose().address for i in range(6)]
+        self.assertEqual(set(chosen), set(["a", "c"]))
+
+    def test_unavailableRecovers(self):
+        """
+        Nodes whose circuit breaker has tripped are chosen again once the
+        breaker allows retesting.
+        """
+        time, cluster = self.create_breaker_cluster("a", "b", "c")
+        cluster.choose()
+        b = cluster.choose()
+        for i in range(3):
+            b.failure()
+        cluster.choose()
+        time.advance(31)
+        chosen = [cluster.choose().address for i in range(6)]
+        self.assertIn("b", chosen)
+
+    def test_departedPolicyKept(self):
+        """
+        An address that returns within the grace period keeps its
+        FailurePolicy.
+        """
+        time, cluster = self.create_breaker_cluster("a", "b")
+        cluster.withTime(time)
+        b = [cluster.choose() for i in range(2)][1]
+        for i in range(3):
+            b.failure()
+        cluster.remove(cluster.nodes[1])
+        time.advance(10.0)
+        cluster.add(create_node("b"))
+        self.assertEqual(set(cluster.choose().address for i in range(4)),
+                         set(["a"]))
+
+    def test_departedPolicyExpires(self):
+        """
+        FailurePolicies of addresses that have been gone longer than the grace
+        period are forgotten.
+        """
+        time, cluster = self.create_breaker_cluster("a", "b", "c")
+        cluster.withTime(time)
+        cluster.remove(cluster._node("b"))
+        time.advance(cluster.policyGrace + 1.0)
+        cluster.remove(cluster._node("c"))
+        self.assertEqual(sorted(cluster._failurepolicies.keys()), ["a", "c"])
+        self.assertEqual(sorted(cluster._latencies.keys()), ["a", "c"])
+
+    def test_policyCap(self):
+        """
+        Only maxPolicies addresses have FailurePolicies, the longest departed
+        are forgotten first.
+        """
+        time, cluster = self.create_breaker_cluster("a")
+        cluster.maxPolicies = 5
+        for i in range(20):
+            node = create_node("address%d" % (i,))
+            cluster.add(node)
+            cluster.remove(node)
+        self.assertEqual(
+            sorted(cluster._failurepolicies.keys()),
+            ["a", "address16", "address17", "address18", "address19"])
+
+    def test_successRestores(self):
+        """A Node that succeeds is immediately available again."""
+        time, cluster = self.create_breaker_cluster("a", "b")
+        b = cluster.chooseVersion("1.0")
+        b = cluster.chooseVersion("1.0")
+        for i in range(3):
+            b.failure()
+        self.assertEqual(cluster.chooseVersion("1.0").address, "a")
+        b.success()
+        chosen = [cluster.chooseVersion("1.0").address for i in range(2)]
+        self.assertEqual(set(chosen), set(["a", "b"]))
+
+    def test_allUnavailable(self):
+        """If all Nodes are unavailable nothing is chosen."""
+        time, cluster = self.create_breaker_cluster("a")
+        a = cluster.choose()
+        for i in range(3):
+            a.failure()
+        self.assertEqual(cluster.choose(), None)
+        time.advance(31)
+        self.assertEqual(cluster.choose().address, "a")
+
+
+class OutlierDetectorTests(TestCase):
+    """Tests for OutlierDetector, used by a Cluster."""
+
+    def interval(self, time, cluster, failing, count=10):
+        """
+        Record results for every Node, with the given addresses always failing,
+        then end the interval.
+        """
+        for node in cluster.nodes:
+            for i in range(count):
+                cluster._recordResult(node.address, node.address not in failing)
+        time.advance(10.0)
+        cluster._recordResult(cluster.nodes[0].address, True)
+
+    def chosen(self, cluster):
+        """Return the set of addresses chosen over several choices."""
+        return set(cluster.choose().address for i in range(20))
+
+    def test_eject(self):
+        """A Node that fails much more than its peers is ejected."""
+        time, cluster = create_outlier_cluster(["a", "b", "c", "d", "e"])
+        self.interval(time, cluster, ["e"])
+        self.assertEqual(self.chosen(cluster), set(["a", "b", "c", "d"]))
+
+    def test_ejectSlow(self):
+        """A Node that is much slower than its peers is ejected."""
+        time, cluster = create_outlier_cluster(["a", "b", "c", "d", "e"])
+        for address in ["a", "b", "c", "d"]:
+            cluster._observeLatency(address, 10.0, time.time())
+        cluster._observeLatency("e", 500.0, time.time())
+        self.interval(time, cluster, [])
+        self.assertEqual(self.chosen(cluster), set(["a", "b", "c", "d"]))
+
+    def test_noOutliers(self):
+        """If all Nodes fail alike none are ejected."""
+        time, cluster = create_outlier_cluster(["a", "b", "c", "d", "e"])
+        self.interval(time, cluster, ["a", "b", "c", "d", "e"])
+        self.assertEqual(len(self.chosen(cluster)), 5)
+
+    def test_minimumNodes(self):
+        """Too few Nodes with enough requests aren't compared."""
+        time, cluster = create_outlier_cluster(["a", "b", "c", "d", "e"])
+        for i in range(10):
+            cluster._recordResult("a", True)
+            cluster._recordResult("b", False)
+        time.advance(10.0)
+        cluster._recordResult("a", True)
+        self.assertEqual(len(self.chosen(cluster)), 5)
+
+    def test_maxEjection(self):
+        """No more than the maximum fraction of Nodes are ejected."""
+        time, cluster = create_outlier_cluster(
+            ["a", "b", "c", "d", "e", "f", "g", "h", "i", "j"])
+        cluster._outliers.maxEjectionFraction = 0.1
+        self.interval(time, cluster, ["a", "b"])
+        self.assertEqual(len(self.chosen(cluster)), 9)
+
+    def test_readmit(self):
+        """Ejected Nodes are chosen again once the ejection time passes."""
+        time, cluster = create_outlier_cluster(["a", "b", "c", "d", "e"])
+        self.interval(time, cluster, ["e"])
+        time.advance(29.0)
+        self.assertNotIn("e", self.chosen(cluster))
+        time.advance(1.1)
+        self.assertIn("e", self.chosen(cluster))
+
+    def test_exponentialEjection(self):
+        """Repeated ejections last exponentially longer."""
+        time, cluster = create_outlier_cluster(["a", "b", "c", "d", "e"])
+        self.interval(time, cluster, ["e"])
+        time.advance(20.0)
+        self.interval(time, cluster, ["e"])
+        time.advance(59.0)
+        self.assertNotIn("e", self.chosen(cluster))
+        time.advance(1.1)
+        self.assertIn("e", self.chosen(cluster))
+
+    def test_nodeResults(self):
+        """Node.success() and Node.failure() are recorded."""
+        time, cluster = create_outlier_cluster(["a", "b", "c", "d", "e"])
+        for i in range(50):
+            node = cluster.choose()
+            if node.address == "e":
+                node.failure()
+            else:
+                node.success()
+        time.advance(10.0)
+        cluster.choose().success()
+        self.assertEqual(self.chosen(cluster), set(["a", "b", "c", "d"]))
+
+    def test_panic(self):
+        """
+        If all Nodes' FailurePolicies say they're unavailable a Node is chosen
+        anyway.
+        """
+        time, cluster = create_outlier_cluster(["a", "b"], CircuitBreakerFactory)
+        for i in range(2):
+            node = cluster.choose()
+            for j in range(3):
+                node.failure()
+        self.assertEqual(len(self.chosen(cluster)), 2)
+
+
+class PeakEWMATests(TestCase):
+    """Tests for PeakEWMA."""
+
+    def test_peak(self):
+        """Higher latencies are adopted immediately."""
+        ewma = PeakEWMA(10.0)
+        ewma.observe(100.0, 0.0)
+        self.assertEqual(ewma.get(), 100.0)
+        ewma.observe(200.0, 0.0)
+        self.assertEqual(ewma.get(), 200.0)
+
+    def test_decay(self):
+        """Lower latencies are averaged in, weighted by elapsed time."""
+        ewma = PeakEWMA(10.0)
+        ewma.observe(100.0, 0.0)
+        ewma.observe(10.0, 10.0)
+        self.assertEqual(ewma.get(), 55.0)
+        ewma.observe(10.0, 10.0)
+        self.assertEqual(ewma.get(), 55.0)
+
+
 class DiscoveryTests(TestCase):
     """Tests for Discovery."""
 
@@ -74,6 +586,65 @@ class DiscoveryTests(TestCase):
         disco.onMessage(None, NodeActive(node))
         self.assertEqual(knownNodes(disco, "myservice", "sandbox"), [node])
 
+    def test_resolveWithoutLock(self):
+        """
+        resolve() of a known service with an available Node doesn't need the
+        Discovery lock.
+        """
+        disco = create_disco()
+        node = create_node("somewhere")
+        disco.onMessage(None, NodeActive(node))
+        # The first resolve() declares interest, which does take the lock:
+        self.assertEqual(resolve(disco, "myservice", "1.0").address,
+                         "somewhere")
+        disco._lock()
+        try:
+            resolved = resolve(disco, "myservice", "1.0")
+        finally:
+            disco._release()
+        self.assertEqual(resolved.address, "somewhere")
+
+    def test_resolveNewInterestWithoutLock(self):
+        """
+        resolve() of a service declared since interests were last merged
+        doesn't need the Discovery lock either.
+        """
+        disco = create_disco()
+        disco.prefetch(["other%d" % (i,) for i in range(100)])
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        self.assertEqual(resolve(disco, "myservice", "1.0").address,
+                         "somewhere")
+        self.assertIn("myservice", disco._newInterests)
+        disco._lock()
+        try:
+            resolved = resolve(disco, "myservice", "1.0")
+        finally:
+            disco._release()
+        self.assertEqual(resolved.address, "somewhere")
+
+    def test_servicesCopyOnWrite(self):
+        """
+        Adding a Cluster replaces the services mapping rather than modifying it.
+        """
+        disco = create_disco()
+        before = disco.services
+        version = disco.servicesVersion
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        self.assertEqual(before, {})
+        self.assertEqual(list(disco.services["sandbox"].keys()), ["myservice"])
+        self.assertEqual(disco.servicesVersion, version + 1)
+
+    def test_emptyClustersUnpublished(self):
+        """
+        A Cluster created while waiting for a service isn't added to services
+        until it has Nodes.
+        """
+        disco = create_disco()
+        disco.resolve("myservice", "1.0", SANDBOX_ENV)
+        self.assertEqual(disco.services, {})
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        self.assertEqual(list(disco.services["sandbox"].keys()), ["myservice"])
+
     def test_resolve(self):
         """resolve() returns a Node matching an active one."""
         disco = create_disco()
@@ -282,6 +853,23 @@ class DiscoveryTests(TestCase):
         resolved_node.success()
         self.assertNodesEqual(resolve(disco, "myservice", "1.0"), node)
 
+    def test_batch(self):
+        """NodeBatch applies its events in order."""
+        disco = create_disco()
+        node1 = create_node("somewhere")
+        node2 = create_node("somewhere2")
+        node3 = create_node("somewhere3")
+        disco.onMessage(None, NodeBatch([
+            NodeActive(node1), NodeActive(node2), NodeExpired(node1),
+            ReplaceCluster("otherservice", SANDBOX_ENV,
+                           [create_node("elsewhere", "otherservice")]),
+            NodeActive(node3),
+        ]))
+        self.assertEqual(knownNodes(disco, "myservice", "sandbox"), [node2, node3])
+        self.assertEqual(
+            [n.address for n in knownNodes(disco, "otherservice", "sandbox")],
+            ["elsewhere"])
+
     def test_notify(self):
         """
         The notify() API allows getting all events passed to the Discovery instance.
@@ -294,6 +882,513 @@ class DiscoveryTests(TestCase):
             disco.onMessage(None, m)
         self.assertEqual(messages, result)
 
+    def test_notifyBatch(self):
+        """
+        notify() callbacks get the events of a NodeBatch one at a time, as if
+        they had arrived separately.
+        """
+        disco = create_disco()
+        events = [NodeActive(create_node("a")), NodeActive(create_node("b"))]
+        result = []
+        disco.notify(result.append)
+        disco.onMessage(None, NodeBatch(events))
+        self.assertEqual(result, events)
+
+
+class WaitingTests(TestCase):
+    """Tests for resolve() requests waiting for a Node."""
+
+    def test_deadlineExpires(self):
+        """
+        A request that isn't answered by its deadline fails with
+        ResolveTimeout and stops waiting.
+        """
+        disco = create_disco()
+        promise = disco.resolveWithin("myservice", "1.0", SANDBOX_ENV, 5.0)
+        self.assertEqual(disco.waitingCount(), 1)
+        advance(disco, 4.5)
+        self.assertEqual((promise.value().hasValue(), disco.waitingCount()),
+                         (False, 1))
+        advance(disco, 1.0)
+        self.assertEqual(disco.waitingCount(), 0)
+        self.assertIsInstance(promise.value().getValue(), ResolveTimeout)
+
+    def test_resolvedBeforeDeadline(self):
+        """A request answered before its deadline stops waiting."""
+        disco = create_disco()
+        promise = disco.resolveWithin("myservice", "1.0", SANDBOX_ENV, 5.0)
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        self.assertEqual(disco.waitingCount(), 0)
+        advance(disco, 10.0)
+        self.assertEqual(promise.value().getValue().address, "somewhere")
+
+    def test_noDeadline(self):
+        """resolve() without a deadline keeps waiting."""
+        disco = create_disco()
+        promise = disco.resolve("myservice", "1.0", SANDBOX_ENV)
+        advance(disco, 1000.0)
+        self.assertEqual((promise.value().hasValue(), disco.waitingCount()),
+                         (False, 1))
+
+    def test_otherMajorVersion(self):
+        """
+        Requests for one major version are only answered by Nodes with that
+        major version and a high enough minor version.
+        """
+        disco = create_disco()
+        promise = disco.resolve("myservice", "2.1", SANDBOX_ENV)
+        node = create_node("somewhere")
+        disco.onMessage(None, NodeActive(node))
+        node2 = create_node("somewhere2")
+        node2.version = "2.0"
+        disco.onMessage(None, NodeActive(node2))
+        self.assertEqual((promise.value().hasValue(), disco.waitingCount()),
+                         (False, 1))
+        node3 = create_node("somewhere3")
+        node3.version = "2.3"
+        disco.onMessage(None, NodeActive(node3))
+        self.assertEqual((promise.value().getValue().address,
+                          disco.waitingCount()), ("somewhere3", 0))
+
+
+class TimerWheelTests(TestCase):
+    """Tests for TimerWheel."""
+
+    def test_expiryOrder(self):
+        """Items are returned once their time is reached, in time order."""
+        wheel = TimerWheel(1.0, 0.0)
+        wheel.schedule("c", 30.0)
+        wheel.schedule("a", 5.0)
+        wheel.schedule("b", 12.0)
+        self.assertEqual(wheel.size(), 3)
+        expired = []
+        for now in range(1, 40):
+            expired.extend(wheel.advance(float(now)))
+        self.assertEqual(expired, ["a", "b", "c"])
+        self.assertEqual(wheel.size(), 0)
+
+    def test_notEarly(self):
+        """Items are never returned before their time."""
+        wheel = TimerWheel(1.0, 0.0)
+        wheel.schedule("a", 5.3)
+        self.assertEqual(wheel.advance(5.2), [])
+        self.assertEqual(wheel.advance(7.6), ["a"])
+
+    def test_farFuture(self):
+        """
+        Items beyond the range of the lowest levels cascade down and are
+        returned at their time, including ones beyond the top level's range.
+        """
+        wheel = TimerWheel(1.0, 0.0)
+        times = [70.0, 5000.0, 300000.0, 20000000.0]
+        for when in times:
+            wheel.schedule(when, when)
+        for when in times:
+            self.assertEqual(wheel.advance(when - 1.0), [])
+            self.assertEqual(wheel.advance(when + 2.0), [when])
+
+    def test_emptyFastForward(self):
+        """Advancing an empty wheel doesn't step through every tick."""
+        wheel = TimerWheel(1.0, 0.0)
+        self.assertEqual(wheel.advance(1e12), [])
+        wheel.schedule("a", 1e12 + 3.0)
+        self.assertEqual(wheel.advance(1e12 + 5.0), ["a"])
+
+
+class ExpiryTests(TestCase):
+    """
+    Tests for Nodes the discovery server reports with a TTL expiring when it
+    passes; DiscoClient sends NodeExpired for them.
+    """
+
+    def start(self, env={}):
+        """Start an MDK connected to a fake discovery server."""
+        self.connector = MDKConnector(env=env, start=False)
+        self.connector.mdk.start()
+        self.connector.pump()
+        self.sev = self.connector.expectSocket()
+        self.connector.connect(self.sev)
+        return self.connector.mdk._disco
+
+    def active(self, node, ttl):
+        """The server reports a Node as active with the given TTL."""
+        active = Active()
+        active.node = node
+        active.ttl = ttl
+        self.sev.send(active.encode())
+        self.connector.pump()
+
+    def addresses(self, disco, service="myservice"):
+        return [n.address for n in knownNodes(disco, service)]
+
+    def test_expires(self):
+        """A Node that isn't reported active again within its TTL is removed."""
+        disco = self.start()
+        self.active(create_node("somewhere"), 5.0)
+        self.connector.advance_time(4.0)
+        self.assertEqual(self.addresses(disco), ["somewhere"])
+        for i in range(3):
+            self.connector.advance_time(1.0)
+        self.assertEqual(self.addresses(disco), [])
+
+    def test_refreshed(self):
+        """A Node reported active again within its TTL is kept."""
+        disco = self.start()
+        node = create_node("somewhere")
+        for i in range(4):
+            self.active(node, 5.0)
+            self.connector.advance_time(3.0)
+        self.active(node, 5.0)
+        self.connector.advance_time(3.0)
+        self.assertEqual(self.addresses(disco), ["somewhere"])
+        for i in range(4):
+            self.connector.advance_time(1.0)
+        self.assertEqual(self.addresses(disco), [])
+
+    def test_noTTL(self):
+        """Nodes reported again without a TTL don't expire."""
+        disco = self.start()
+        node = create_node("somewhere")
+        self.active(node, 5.0)
+        self.active(node, -1.0)
+        self.connector.advance_time(1000.0)
+        self.connector.advance_time(1.0)
+        self.assertEqual(self.addresses(disco), ["somewhere"])
+
+    def test_expiredExplicitly(self):
+        """
+        A Node the server expires and reports again without a TTL isn't
+        expired by its earlier TTL.
+        """
+        disco = self.start()
+        node = create_node("somewhere")
+        self.active(node, 5.0)
+        expire = Expire()
+        expire.node = node
+        self.sev.send(expire.encode())
+        self.connector.pump()
+        self.active(node, -1.0)
+        for i in range(10):
+            self.connector.advance_time(1.0)
+        self.assertEqual(self.addresses(disco), ["somewhere"])
+
+    def test_fallback(self):
+        """
+        A Node from the discovery server, handed to Discovery in a
+        ReplaceCluster when it takes over from the fallback source, still
+        expires, and then the fallback source's Nodes are used again.
+        """
+        fallback = dumps([{"service": "myservice", "address": "fallback",
+                           "version": "1.0",
+                           "environment": {"name": "sandbox",
+                                           "fallbackName": None}}])
+        disco = self.start(
+            {"MDK_DISCOVERY_SOURCE": "datawire:xxx|static:nodes=" + fallback})
+        self.assertEqual(self.addresses(disco), ["fallback"])
+        self.active(create_node("somewhere"), 5.0)
+        self.assertEqual(self.addresses(disco), ["somewhere"])
+        for i in range(7):
+            self.connector.advance_time(1.0)
+        self.assertEqual(self.addresses(disco), ["fallback"])
+
+
+class ReclaimTests(TestCase):
+    """Tests for reclaiming unused Clusters."""
+
+    def test_reclaimAfterWaiting(self):
+        """
+        A Cluster created for a resolve() that never found a Node is reclaimed
+        once the request expires.
+        """
+        disco = create_disco()
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        disco.resolveWithin("unknown", "1.0", SANDBOX_ENV, 1.0)
+        self.assertEqual(disco.clusterCount(), 2)
+        disco.runtime.dispatcher.pump()
+        time = disco.runtime.getTimeService()
+        time.advance(1.0)
+        time.pump()
+        disco.runtime.dispatcher.pump()
+        self.assertEqual((disco.clusterCount(), disco.clustersCreated,
+                          disco.clustersReclaimed), (1, 2, 1))
+        self.assertEqual(disco._findCluster("unknown", SANDBOX_ENV), None)
+        self.assertEqual(resolve(disco, "myservice", "1.0").address, "somewhere")
+
+    def test_expireUnknownCreatesNothing(self):
+        """
+        NodeExpired for a service Discovery doesn't know doesn't create a
+        Cluster.
+        """
+        disco = create_disco()
+        disco.onMessage(None, NodeExpired(create_node("somewhere", "unknown")))
+        self.assertEqual((disco.clusterCount(), disco.clustersCreated), (0, 0))
+        self.assertEqual(disco._findCluster("unknown", SANDBOX_ENV), None)
+
+    def test_cap(self):
+        """
+        Beyond the maximum number of Clusters, the less recently used empty
+        Clusters nobody is waiting on are reclaimed.
+        """
+        disco = create_disco()
+        disco._maxClusters = 10
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        disco.resolve("waiting", "1.0", SANDBOX_ENV)
+        for i in range(100):
+            knownNodes(disco, "unknown%d" % (i,))
+        self.assertTrue(disco.clusterCount() <= 10)
+        self.assertEqual(disco.clusterCount(),
+                         disco.clustersCreated - disco.clustersReclaimed)
+        # Most recently used Clusters, Clusters with Nodes and Clusters with
+        # waiters are kept:
+        self.assertNotEqual(disco._findCluster("unknown99", SANDBOX_ENV), None)
+        self.assertEqual(disco._findCluster("unknown0", SANDBOX_ENV), None)
+        self.assertEqual(disco.waitingCount(), 1)
+        self.assertEqual(resolve(disco, "myservice", "1.0").address, "somewhere")
+
+    def test_evictInBatches(self):
+        """
+        Eviction goes down to 90% of the maximum number of Clusters, so it
+        doesn't happen again until that many more are created.
+        """
+        disco = create_disco()
+        disco._maxClusters = 10
+        for i in range(11):
+            knownNodes(disco, "unknown%d" % (i,))
+        self.assertEqual(disco.clusterCount(), 9)
+        reclaimed = disco.clustersReclaimed
+        knownNodes(disco, "another")
+        self.assertEqual(disco.clusterCount(), 10)
+        self.assertEqual(disco.clustersReclaimed, reclaimed)
+
+    def test_evictInterests(self):
+        """Interest in evicted services is forgotten."""
+        disco = create_disco()
+        disco._maxClusters = 10
+        for i in range(100):
+            disco.resolveWithin("unknown%d" % (i,), "1.0", SANDBOX_ENV, 1.0)
+            advance(disco, 1.0)
+        interests = (set(disco._interests.keys()) |
+                     set(disco._newInterests.keys()))
+        self.assertTrue(len(interests) <= 10)
+        self.assertIn("unknown99", interests)
+
+
+class UnknownServiceTests(TestCase):
+    """Tests for resolving services no DiscoverySource knows about."""
+
+    def create_disco(self, grace):
+        """Create a Discovery that waits grace seconds for unknown services."""
+        disco = create_disco().withUnknownServiceGrace(grace)
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        return disco
+
+    def test_waitBeforeSync(self):
+        """Until the source has synced, resolve() waits for unknown services."""
+        disco = self.create_disco(0.0)
+        promise = disco.resolve("unknown", "1.0", SANDBOX_ENV)
+        self.assertFalse(promise.value().hasValue())
+
+    def test_failImmediately(self):
+        """
+        With no grace period, once the source has synced resolve() fails
+        immediately for unknown services, without creating a Cluster.
+        """
+        disco = self.create_disco(0.0)
+        disco.onMessage(None, SyncComplete())
+        promise = disco.resolve("unknown", "1.0", SANDBOX_ENV)
+        self.assertIsInstance(promise.value().getValue(), UnknownService)
+        self.assertEqual(disco._findCluster("unknown", SANDBOX_ENV), None)
+        self.assertEqual(resolve(disco, "myservice", "1.0").address, "somewhere")
+
+    def test_grace(self):
+        """
+        With a grace period resolve() waits for it, and afterwards resolves
+        fail immediately.
+        """
+        disco = self.create_disco(3.0)
+        disco.onMessage(None, NodeBatch([SyncComplete()]))
+        promise = disco.resolve("unknown", "1.0", SANDBOX_ENV)
+        advance(disco, 2.0)
+        self.assertFalse(promise.value().hasValue())
+        advance(disco, 1.5)
+        self.assertIsInstance(promise.value().getValue(), UnknownService)
+        promise2 = disco.resolve("unknown", "1.0", SANDBOX_ENV)
+        self.assertIsInstance(promise2.value().getValue(), UnknownService)
+
+    def test_negativeCacheExpires(self):
+        """After the negative cache TTL passes a new grace period starts."""
+        disco = self.create_disco(3.0)
+        disco.onMessage(None, SyncComplete())
+        disco.resolve("unknown", "1.0", SANDBOX_ENV)
+        advance(disco, 3.0 + disco._unknownTtl)
+        promise = disco.resolve("unknown", "1.0", SANDBOX_ENV)
+        self.assertFalse(promise.value().hasValue())
+
+    def test_newService(self):
+        """A service that gets Nodes is no longer unknown."""
+        disco = self.create_disco(0.0)
+        disco.onMessage(None, SyncComplete())
+        disco.resolve("unknown", "1.0", SANDBOX_ENV)
+        disco.onMessage(None, NodeActive(create_node("there", "unknown")))
+        self.assertEqual(resolve(disco, "unknown", "1.0").address, "there")
+
+    def test_unknownBounded(self):
+        """
+        Unknown services are remembered only up to the Cluster limit; expired
+        ones are forgotten first.
+        """
+        disco = self.create_disco(0.0)
+        disco._maxClusters = 10
+        disco.onMessage(None, SyncComplete())
+        for i in range(10):
+            disco.resolve("old%d" % (i,), "1.0", SANDBOX_ENV)
+        advance(disco, disco._unknownTtl + 1.0)
+        disco.resolve("recent", "1.0", SANDBOX_ENV)
+        self.assertEqual(list(disco._unknown.keys()), ["recent"])
+        for i in range(100):
+            disco.resolve("new%d" % (i,), "1.0", SANDBOX_ENV)
+        self.assertTrue(len(disco._unknown.keys()) <= 10)
+
+    def test_staticRoutesSync(self):
+        """StaticRoutes sends SyncComplete after its Nodes."""
+        disco = create_disco().withUnknownServiceGrace(0.0)
+        static = StaticRoutes([create_node("a")]).create(disco, disco.runtime)
+        disco.runtime.dispatcher.startActor(static)
+        disco.runtime.dispatcher.pump()
+        promise = disco.resolve("unknown", "1.0", SANDBOX_ENV)
+        self.assertIsInstance(promise.value().getValue(), UnknownService)
+
+
+class SnapshotTests(TestCase):
+    """Tests for Discovery snapshots."""
+
+    def create_disco(self, path):
+        """Create and start a Discovery that snapshots to the given path."""
+        runtime = fake_runtime()
+        disco = Discovery(runtime).withSnapshot(path)
+        disco.onStart(runtime.dispatcher)
+        runtime.dispatcher.pump()
+        return disco
+
+    def stop(self, disco):
+        """Stop a Discovery and deliver the write of its snapshot."""
+        disco.onStop()
+        disco.runtime.dispatcher.pump()
+
+    def snapshot_path(self):
+        """Return a path for a snapshot file that doesn't exist yet."""
+        files = fake_runtime().getFileService()
+        return files.mktempdir() + "/snapshot.json"
+
+    def test_periodicSave(self):
+        """Known Nodes are written to the snapshot file periodically."""
+        path = self.snapshot_path()
+        disco = self.create_disco(path)
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        files = disco.runtime.getFileService()
+        self.assertEqual(files.read(path), None)
+        advance(disco, 31)
+        loaded = self.create_disco(path)
+        self.assertEqual(
+            [n.address for n in knownNodes(loaded, "myservice")],
+            ["somewhere"])
+
+    def test_saveOnStop(self):
+        """Known Nodes are written to the snapshot file when stopping."""
+        path = self.snapshot_path()
+        disco = self.create_disco(path)
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        self.stop(disco)
+        loaded = self.create_disco(path)
+        self.assertEqual(resolve(loaded, "myservice", "1.0").address,
+                         "somewhere")
+
+    def test_loadedAreStale(self):
+        """Nodes loaded from a snapshot are stale until seen in live data."""
+        path = self.snapshot_path()
+        disco = self.create_disco(path)
+        node = create_node("somewhere")
+        disco.onMessage(None, NodeActive(node))
+        disco.onMessage(None, NodeActive(create_node("somewhere2")))
+        self.stop(disco)
+        loaded = self.create_disco(path)
+        cluster = loaded._findCluster("myservice", SANDBOX_ENV)
+        self.assertEqual((cluster.isStale("somewhere"),
+                          cluster.isStale("somewhere2")), (True, True))
+        loaded.onMessage(None, NodeActive(node))
+        self.assertEqual((cluster.isStale("somewhere"),
+                          cluster.isStale("somewhere2")), (False, True))
+
+    def test_replaceConfirms(self):
+        """ReplaceCluster replaces loaded Nodes with live data."""
+        path = self.snapshot_path()
+        disco = self.create_disco(path)
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        self.stop(disco)
+        loaded = self.create_disco(path)
+        loaded.onMessage(None, ReplaceCluster("myservice", SANDBOX_ENV,
+                                              [create_node("elsewhere")]))
+        self.assertEqual(
+            [n.address for n in knownNodes(loaded, "myservice")],
+            ["elsewhere"])
+        self.assertFalse(loaded._findCluster(
+            "myservice", SANDBOX_ENV).isStale("elsewhere"))
+
+    def test_unconfirmedExpire(self):
+        """
+        Loaded Nodes that live data doesn't confirm are removed a grace period
+        after live data starts arriving.
+        """
+        path = self.snapshot_path()
+        disco = self.create_disco(path)
+        node = create_node("somewhere")
+        disco.onMessage(None, NodeActive(node))
+        disco.onMessage(None, NodeActive(create_node("somewhere2")))
+        self.stop(disco)
+        loaded = self.create_disco(path)
+        # Without live data stale Nodes are kept:
+        advance(loaded, 120)
+        self.assertEqual(len(knownNodes(loaded, "myservice")), 2)
+        loaded.onMessage(None, NodeActive(node))
+        loaded.runtime.dispatcher.pump()
+        advance(loaded, 59)
+        self.assertEqual(len(knownNodes(loaded, "myservice")), 2)
+        advance(loaded, 2)
+        self.assertEqual(
+            [n.address for n in knownNodes(loaded, "myservice")],
+            ["somewhere"])
+
+    def test_writeLater(self):
+        """
+        The snapshot is written by the file service, not while Discovery
+        handles the event that saves it.
+        """
+        path = self.snapshot_path()
+        disco = self.create_disco(path)
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        disco.onStop()
+        files = disco.runtime.getFileService()
+        self.assertEqual(files.read(path), None)
+        disco.runtime.dispatcher.pump()
+        self.assertNotEqual(files.read(path), None)
+
+    def test_modeKept(self):
+        """Writing the snapshot keeps the existing file's mode."""
+        path = self.snapshot_path()
+        fake_runtime().getFileService().write(path, "[]")
+        os.chmod(path, 0o640)
+        disco = self.create_disco(path)
+        disco.onMessage(None, NodeActive(create_node("somewhere")))
+        self.stop(disco)
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o640)
+
+    def test_corruptSnapshot(self):
+        """An unreadable snapshot file is ignored."""
+        path = self.snapshot_path()
+        fake_runtime().getFileService().write(path, "not json")
+        disco = self.create_disco(path)
+        self.assertEqual(disco._clusters(), [])
+
 
 class DiscoveryEnvironmentTests(TestCase):
     """Tests for interaction between Discovery and environments."""
@@ -504,6 +1599,121 @@ class CircuitBreakerTests(TestCase):
         self.assertEqual((available0, available1, available2, available3, available4),
                          (True, True, True, False, False))
 
+    def trip(self):
+        """Trip the breaker and wait until it is half-open."""
+        for i in range(3):
+            self.circuit_breaker.failure()
+        self.time.advance(30.1)
+
+    def test_halfOpenSingleProbe(self):
+        """Once the retest delay has passed only one caller is let through."""
+        self.trip()
+        self.assertEqual([self.circuit_breaker.available() for i in range(3)],
+                         [True, False, False])
+
+    def test_halfOpenProbes(self):
+        """The number of concurrent probes is configurable."""
+        factory = CircuitBreakerFactory(fake_runtime())
+        factory.probes = 2
+        self.circuit_breaker = factory.create()
+        self.time = factory.time
+        self.trip()
+        self.assertEqual([self.circuit_breaker.available() for i in range(3)],
+                         [True, True, False])
+
+    def test_probeSuccess(self):
+        """A successful probe closes the breaker."""
+        self.trip()
+        self.circuit_breaker.available()
+        self.circuit_breaker.success()
+        self.assertEqual([self.circuit_breaker.available() for i in range(3)],
+                         [True, True, True])
+
+    def test_probeFailure(self):
+        """
+        A failed probe reopens the breaker, until the retest delay passes
+        again.
+        """
+        self.trip()
+        self.circuit_breaker.available()
+        self.circuit_breaker.failure()
+        available = self.circuit_breaker.available()
+        self.time.advance(30.1)
+        self.assertEqual((available, self.circuit_breaker.available()),
+                         (False, True))
+
+    def test_probeExpires(self):
+        """A probe that never reports back is forgotten after the retest delay."""
+        self.trip()
+        self.circuit_breaker.available()
+        self.time.advance(29.0)
+        available29sec = self.circuit_breaker.available()
+        self.time.advance(1.1)
+        available30sec = self.circuit_breaker.available()
+        self.assertEqual((available29sec, available30sec), (False, True))
+
+class FailureRatePolicyTests(TestCase):
+    """
+    Tests for FailureRatePolicy.
+    """
+    def setUp(self):
+        runtime = fake_runtime()
+        self.time = runtime.getTimeService()
+        self.policy = FailureRatePolicyFactory(runtime).create()
+
+    def record(self, successes, failures):
+        """Record the given number of successes and failures."""
+        for i in range(successes):
+            self.policy.success()
+        for i in range(failures):
+            self.policy.failure()
+
+    def test_highFailureRate(self):
+        """If half the requests fail the Node becomes unavailable."""
+        self.record(10, 9)
+        available1 = self.policy.available()
+        self.record(0, 1)
+        available2 = self.policy.available()
+        self.assertEqual((available1, available2), (True, False))
+
+    def test_interleavedFailures(self):
+        """
+        Failures interleaved with successes disable the Node, unlike with
+        CircuitBreaker.
+        """
+        for i in range(20):
+            self.record(1, 1)
+        self.assertFalse(self.policy.available())
+
+    def test_minimumRequests(self):
+        """Too few requests don't disable the Node, even if all fail."""
+        self.record(0, 19)
+        self.assertTrue(self.policy.available())
+
+    def test_lowFailureRate(self):
+        """A low failure rate doesn't disable the Node."""
+        self.record(70, 30)
+        self.assertTrue(self.policy.available())
+
+    def test_window(self):
+        """Results older than the window are forgotten."""
+        self.record(0, 15)
+        self.time.advance(11.0)
+        self.record(0, 15)
+        self.assertTrue(self.policy.available())
+
+    def test_retest(self):
+        """After the retest delay the Node is available again."""
+        self.record(0, 20)
+        self.time.advance(29.0)
+        available29sec = self.policy.available()
+        self.time.advance(1.1)
+        available30sec = self.policy.available()
+        self.record(0, 1)
+        self.assertEqual((available29sec, available30sec, self.policy.available()),
+                         (False, True, True))
+
+
 class FakeDiscovery(object):
     """Parallel, simplified Discovery state tracking implementation."""
 
@@ -643,6 +1853,121 @@ class StaticDiscoverySourceTests(TestCase):
         self.assertEqual((node2.address, node2.version), ("b", "2.0"))
 
 
+class FakeSource(DiscoverySource):
+    """DiscoverySource whose events are sent by tests."""
+
+    def __init__(self, subscriber):
+        self.subscriber = subscriber
+        self.received = []
+
+    def onStart(self, dispatcher):
+        self.dispatcher = dispatcher
+
+    def onStop(self):
+        pass
+
+    def onMessage(self, origin, message):
+        self.received.append(message)
+
+    def send(self, event):
+        """Send an event to the subscriber."""
+        self.dispatcher.tell(self, event, self.subscriber)
+
+
+class FakeSourceFactory(DiscoverySourceFactory):
+    """Creates FakeSources."""
+
+    def __init__(self, registrar=False):
+        self.registrar = registrar
+        self.sources = []
+
+    def create(self, subscriber, runtime):
+        source = FakeSource(subscriber)
+        self.sources.append(source)
+        return source
+
+    def isRegistrar(self):
+        return self.registrar
+
+
+class CompositeSourceTests(TestCase):
+    """Tests for CompositeSourceFactory."""
+
+    def setUp(self):
+        self.runtime = fake_runtime()
+        self.disco = Discovery(self.runtime)
+        self.runtime.dispatcher.startActor(self.disco)
+        self.primary_factory = FakeSourceFactory(registrar=True)
+        self.fallback_factory = FakeSourceFactory()
+        self.factory = CompositeSourceFactory(
+            [self.primary_factory, self.fallback_factory])
+        self.composite = self.factory.create(self.disco, self.runtime)
+        self.runtime.dispatcher.startActor(self.composite)
+        self.runtime.dispatcher.pump()
+        [self.primary] = self.primary_factory.sources
+        [self.fallback] = self.fallback_factory.sources
+
+    def send(self, source, event):
+        """Send an event from a source and deliver it."""
+        source.send(event)
+        self.runtime.dispatcher.pump()
+
+    def addresses(self):
+        return [n.address for n in knownNodes(self.disco, "myservice")]
+
+    def test_highestPriority(self):
+        """Nodes come from the highest priority source that has any."""
+        self.send(self.fallback, NodeActive(create_node("fallback")))
+        self.assertEqual(self.addresses(), ["fallback"])
+        self.send(self.primary, NodeActive(create_node("primary")))
+        self.assertEqual(self.addresses(), ["primary"])
+        self.send(self.fallback, NodeActive(create_node("fallback2")))
+        self.assertEqual(self.addresses(), ["primary"])
+
+    def test_fallback(self):
+        """
+        If the highest priority source loses all its Nodes, the next source's
+        Nodes are used.
+        """
+        self.send(self.fallback, NodeActive(create_node("fallback")))
+        primary = create_node("primary")
+        self.send(self.primary, NodeActive(primary))
+        self.send(self.primary, NodeExpired(primary))
+        self.assertEqual(self.addresses(), ["fallback"])
+
+    def test_lastNodeRemoved(self):
+        """If no source has Nodes for a cluster it is emptied."""
+        node = create_node("primary")
+        self.send(self.primary, NodeActive(node))
+        self.send(self.primary, NodeExpired(node))
+        self.assertEqual(self.addresses(), [])
+
+    def test_batch(self):
+        """NodeBatch events are merged like individual events."""
+        self.send(self.fallback, NodeBatch([
+            NodeActive(create_node("fallback")),
+            ReplaceCluster("other", SANDBOX_ENV, [create_node("x", "other")])]))
+        self.assertEqual(self.addresses(), ["fallback"])
+        self.assertEqual(
+            [n.address for n in knownNodes(self.disco, "other")], ["x"])
+
+    def test_syncComplete(self):
+        """SyncComplete is only forwarded once all sources have synced."""
+        self.send(self.primary, SyncComplete())
+        self.assertFalse(self.disco._synced)
+        self.send(self.fallback, SyncComplete())
+        self.assertTrue(self.disco._synced)
+
+    def test_registrar(self):
+        """RegisterNode messages are forwarded to the first registrar."""
+        self.assertTrue(self.factory.isRegistrar())
+        register = RegisterNode(create_node("a"))
+        self.runtime.dispatcher.tell(None, register, self.composite)
+        self.runtime.dispatcher.pump()
+        self.assertEqual(self.primary.received, [register])
+        self.assertEqual(self.fallback.received, [])
+
+
 class DiscoveryProtocolTests(TestCase):
     """Tests for the Discovery protocol.
 
@@ -735,6 +2060,243 @@ class DiscoveryProtocolTests(TestCase):
         self.pump()
         return active.node
 
+    def testActiveBatched(self):
+        """
+        Active messages that arrive together are delivered to Discovery as a
+        single NodeBatch, whose events notify() callbacks get one at a time.
+        """
+        disco = self.createDisco()
+        sev = self.startDisco()
+        batches = []
+        received = []
+        original = disco._batch
+        disco._batch = lambda events: (batches.append(events), original(events))
+        disco.notify(received.append)
+        for addr in ["addr1", "addr2", "addr3"]:
+            active = Active()
+            active.node = create_node(addr, "svc")
+            sev.send(active.encode())
+        self.pump()
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([type(message) for message in received],
+                         [NodeActive] * 3)
+        self.assertEqual(
+            [n.address for n in knownNodes(disco, "svc", "sandbox")],
+            ["addr1", "addr2", "addr3"])
+
+    def expectInterest(self, ws_actor):
+        self.pump()
+        return self.connector.expectSerializable(
+            ws_actor, "mdk_discovery.protocol.Interest")
+
+    def serverInterest(self, sev, services):
+        """The server acknowledges an Interest."""
+        interest = Interest()
+        interest.services = services
+        sev.send(interest.encode())
+        self.pump()
+
+    def testInterestOnResolve(self):
+        """Resolving a service declares interest in it to the server."""
+        disco = self.createDisco()
+        sev = self.startDisco()
+        disco.resolve("svc", "1.0", SANDBOX_ENV)
+        self.assertEqual(self.expectInterest(sev).services, ["svc"])
+        disco.resolve("svc2", "1.0", SANDBOX_ENV)
+        # Interests are sent at most once a second:
+        self.connector.advance_time(1.0)
+        self.assertEqual(sorted(self.expectInterest(sev).services),
+                         ["svc", "svc2"])
+
+    def testUnknownAfterInterest(self):
+        """
+        With MDK_UNKNOWN_SERVICES=fail, a service first resolved after syncing
+        with a server that filters by interest isn't rejected before the
+        server has been told about it and had time to answer.
+        """
+        self.connector = MDKConnector(
+            env={"MDK_UNKNOWN_SERVICES": "fail"}, start=False)
+        disco = self.createDisco()
+        disco.prefetch(["svc"])
+        sev = self.startDisco()
+        self.expectInterest(sev)
+        self.serverInterest(sev, ["svc"])
+        self.connector.advance_time(5.0)
+        self.assertTrue(disco._synced)
+
+        promise = disco.resolve("new", "1.0", SANDBOX_ENV)
+        missing = disco.resolve("missing", "1.0", SANDBOX_ENV)
+        self.pump()
+        self.assertFalse(promise.value().hasValue())
+        self.assertFalse(missing.value().hasValue())
+        self.connector.advance_time(1.0)
+        self.assertEqual(sorted(self.expectInterest(sev).services),
+                         ["missing", "new", "svc"])
+        self.doActive(sev, "new", "addr", "1.0")
+        self.assertEqual(promise.value().getValue().address, "addr")
+        # Services the server doesn't report are unknown once it's had time:
+        self.connector.advance_time(5.0)
+        self.assertIsInstance(missing.value().getValue(), UnknownService)
+
+    def testInterestCoalesced(self):
+        """Services resolved in quick succession are declared together."""
+        disco = self.createDisco()
+        sev = self.startDisco()
+        disco.resolve("svc", "1.0", SANDBOX_ENV)
+        self.expectInterest(sev)
+        for i in range(10):
+            disco.resolve("svc%d" % (i,), "1.0", SANDBOX_ENV)
+        self.pump()
+        self.assertEqual(
+            [msg for msg in sev.sent[sev.expectIdx:]
+             if loads(msg)["type"] == "interest"], [])
+        self.connector.advance_time(1.0)
+        self.assertEqual(len(self.expectInterest(sev).services), 11)
+
+    def testRemoveInterest(self):
+        """RemoveInterest drops services from the next Interest."""
+        disco = self.createDisco()
+        sev = self.startDisco()
+        disco.prefetch(["svc1", "svc2"])
+        self.expectInterest(sev)
+        self.connector.mdk._discoSource.onMessage(None, RemoveInterest(["svc1"]))
+        self.connector.advance_time(1.0)
+        self.assertEqual(self.expectInterest(sev).services, ["svc2"])
+
+    def testExpireUnfiltered(self):
+        """
+        Expire messages are passed on even for services that aren't of
+        interest, since their Nodes may have been reported earlier.
+        """
+        disco = self.createDisco()
+        sev = self.startDisco()
+        disco.resolve("svc", "1.0", SANDBOX_ENV)
+        self.pump()
+        node = self.doActive(sev, "other", "addr", "1.0")
+        self.serverInterest(sev, ["svc"])
+        expire = Expire()
+        expire.node = node
+        sev.send(expire.encode())
+        self.pump()
+        self.assertEqual(knownNodes(disco, "other", "sandbox"), [])
+
+    def testPrefetchPreStart(self):
+        """Services prefetched before connecting are declared on connection."""
+        self.connector.mdk.prefetch(["svc1", "svc2"])
+        sev = self.startDisco()
+        self.assertEqual(sorted(self.expectInterest(sev).services),
+                         ["svc1", "svc2"])
+
+    def testLegacyServerUnfiltered(self):
+        """
+        If the server doesn't acknowledge the Interest, all Nodes it sends are
+        used.
+        """
+        disco = self.createDisco()
+        sev = self.startDisco()
+        disco.resolve("svc", "1.0", SANDBOX_ENV)
+        self.pump()
+        self.doActive(sev, "other", "addr", "1.0")
+        self.assertEqual(
+            [n.address for n in knownNodes(disco, "other", "sandbox")], ["addr"])
+
+    def testFiltered(self):
+        """
+        Once the server acknowledges the Interest, Nodes of other services are
+        ignored.
+        """
+        disco = self.createDisco()
+        sev = self.startDisco()
+        disco.resolve("svc", "1.0", SANDBOX_ENV)
+        self.pump()
+        self.serverInterest(sev, ["svc"])
+        self.doActive(sev, "other", "addr", "1.0")
+        self.doActive(sev, "svc", "addr2", "1.0")
+        self.assertEqual(knownNodes(disco, "other", "sandbox"), [])
+        self.assertEqual(
+            [n.address for n in knownNodes(disco, "svc", "sandbox")], ["addr2"])
+
+    def testRepeatedActiveSkipped(self):
+        """
+        An Active frame identical to an earlier one isn't decoded again; the
+        Node it decoded to is passed on to Discovery again.
+        """
+        disco = self.createDisco()
+        sev = self.startDisco()
+        received = []
+        disco.notify(received.append)
+        active = Active()
+        active.node = create_node("addr", "svc")
+        frame = active.encode()
+        sev.send(frame)
+        self.pump()
+        [node] = knownNodes(disco, "svc", "sandbox")
+        sev.send(frame)
+        self.pump()
+        self.assertEqual(len(received), 2)
+        self.assertEqual(self.connector.mdk._wsclient.frames.repeats, 1)
+        self.assertIs(knownNodes(disco, "svc", "sandbox")[0], node)
+
+    def testExpireInvalidatesOnlyItsNode(self):
+        """
+        An Expire forgets the cached frame of its own Node, not those of other
+        Nodes.
+        """
+        self.createDisco()
+        sev = self.startDisco()
+        frames = self.connector.mdk._wsclient.frames
+        first = Active()
+        first.node = create_node("addr1", "svc")
+        second = Active()
+        second.node = create_node("addr2", "svc")
+        for active in [first, second]:
+            sev.send(active.encode())
+        self.pump()
+        expire = Expire()
+        expire.node = first.node
+        sev.send(expire.encode())
+        self.pump()
+        self.assertEqual(frames.lastSeen(first.encode()), -1.0)
+        self.assertNotEqual(frames.lastSeen(second.encode()), -1.0)
+
+    def testNewFrameReplacesOld(self):
+        """A changed Active for a Node replaces its cached frame."""
+        self.createDisco()
+        sev = self.startDisco()
+        frames = self.connector.mdk._wsclient.frames
+        active = Active()
+        active.node = create_node("addr", "svc")
+        old = active.encode()
+        sev.send(old)
+        self.pump()
+        active.node.properties = {"changed": True}
+        sev.send(active.encode())
+        self.pump()
+        self.assertEqual(frames.lastSeen(old), -1.0)
+        self.assertEqual(frames._size, 1)
+
+    def testRepeatedActiveAfterExpire(self):
+        """
+        An Active frame identical to an earlier one is used if a Node was
+        expired in between.
+        """
+        disco = self.createDisco()
+        sev = self.startDisco()
+        active = Active()
+        active.node = create_node("addr", "svc")
+        frame = active.encode()
+        sev.send(frame)
+        self.pump()
+        expire = Expire()
+        expire.node = active.node
+        sev.send(expire.encode())
+        self.pump()
+        self.assertEqual(knownNodes(disco, "svc", "sandbox"), [])
+        sev.send(frame)
+        self.pump()
+        self.assertEqual(
+            [n.address for n in knownNodes(disco, "svc", "sandbox")], ["addr"])
+
     def testResolvePreStart(self):
         disco = self.createDisco()
 
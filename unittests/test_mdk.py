@@ -18,6 +18,8 @@ from mdk_runtime import fakeRuntime
 from mdk_runtime.actors import _QuarkRuntimeLaterCaller
 from mdk_discovery import (
     ReplaceCluster, NodeActive, RecordingFailurePolicyFactory,
+    LeastOutstanding, LeastOutstandingFactory, FailureRatePolicyFactory,
+    CompositeSourceFactory, _CompositeSource,
 )
 from mdk_protocol import Close, ProtocolError
 
@@ -60,6 +62,70 @@ class MDKInitializationTestCase(TestCase):
         # No WebSocket connections made:
         self.assertFalse(runtime.getWebSocketsService().fakeActors)
 
+    def test_load_balancer(self):
+        """
+        MDK_LOAD_BALANCER=leastoutstanding makes Discovery use LeastOutstanding.
+        """
+        connector = MDKConnector(env={"MDK_LOAD_BALANCER": "leastoutstanding"})
+        self.assertIsInstance(
+            connector.runtime.dependencies.getService("loadbalancer_factory"),
+            LeastOutstandingFactory)
+
+    def test_failure_rate(self):
+        """
+        MDK_FAILURE_POLICY=failurerate makes Discovery use FailureRatePolicy.
+        """
+        connector = MDKConnector(env={"MDK_FAILURE_POLICY": "failurerate"})
+        self.assertIsInstance(
+            connector.runtime.dependencies.getService("failurepolicy_factory"),
+            FailureRatePolicyFactory)
+
+    def test_unknown_services(self):
+        """
+        MDK_UNKNOWN_SERVICES=fail:<seconds> sets the grace period for unknown
+        services; invalid values wait forever.
+        """
+        for value, expected in [("fail", 0.0), ("fail:5", 5.0), ("", -1.0),
+                                ("fail:abc", -1.0), ("fail:0.5", -1.0),
+                                ("fail:-3", -1.0)]:
+            runtime = fakeRuntime()
+            runtime.getEnvVarsService().set("MDK_UNKNOWN_SERVICES", value)
+            mdk = MDKImpl(runtime)
+            self.assertEqual(mdk.getUnknownServiceGrace(runtime), expected)
+
+    def test_composite_discovery_source(self):
+        """
+        MDK_DISCOVERY_SOURCE with several sources separated by '|' combines
+        them, and the token for a datawire: source is used by the WSClient.
+        """
+        runtime = fakeRuntime()
+        runtime.getEnvVarsService().set(
+            "MDK_DISCOVERY_SOURCE",
+            "datawire:xxx|synapse:path=" + mkdtemp())
+        mdk = MDKImpl(runtime)
+        self.assertIsInstance(
+            mdk.getDiscoveryFactory(runtime.getEnvVarsService()),
+            CompositeSourceFactory)
+        self.assertIsInstance(mdk._discoSource, _CompositeSource)
+        self.assertNotEqual(mdk._wsclient, None)
+        self.assertIs(
+            runtime.dependencies.getService("discovery_registrar"),
+            mdk._discoSource)
+
+    def test_discovery_source_pipe_in_json(self):
+        """
+        A '|' inside a source's configuration, e.g. static:nodes= JSON, doesn't
+        separate sources; only a '|' followed by a known prefix does.
+        """
+        runtime = fakeRuntime()
+        mdk = MDKImpl(runtime)
+        nodes = '[{"service": "a|b", "address": "x"}]'
+        self.assertEqual(
+            mdk._discoverySources("static:nodes=" + nodes + "|datawire:xxx"),
+            ["static:nodes=" + nodes, "datawire:xxx"])
+        self.assertEqual(mdk._discoverySources("static:nodes=" + nodes),
+                         ["static:nodes=" + nodes])
+
 
 def add_bools(list_of_lists):
     """
@@ -185,6 +251,35 @@ class InteractionTestCase(TestCase):
 
         self.assertPolicyState([self.disco.failurePolicy(node)], 1, 1)
 
+    def test_inFlight(self):
+        """
+        Nodes resolved within an interaction are counted as in flight by the
+        LoadBalancer until the interaction is finished or failed.
+        """
+        balancer = LeastOutstanding()
+        self.disco._getCluster("service1", SANDBOX_ENV).withBalancer(balancer)
+        self.session.start_interaction()
+        node = self.session.resolve("service1", "1.0")
+        self.assertEqual(balancer._count(node.address), 1)
+        self.session.fail_interaction("OHNO")
+        self.assertEqual(balancer._count(node.address), 0)
+        node = self.session.resolve("service1", "1.0")
+        self.assertEqual(balancer._count(node.address), 1)
+        self.session.finish_interaction()
+        self.assertEqual(balancer._count(node.address), 0)
+
+    def test_latency(self):
+        """
+        The duration of a finished interaction is recorded as the latency of
+        the Nodes involved.
+        """
+        self.session.start_interaction()
+        node = self.session.resolve("service1", "1.0")
+        self.runtime.getTimeService().advance(0.5)
+        self.session.finish_interaction()
+        cluster = self.disco._getCluster("service1", SANDBOX_ENV)
+        self.assertEqual(cluster.latency(node.address), 500.0)
+
     @given(st.recursive(st.text(alphabet="abcd", min_size=1, max_size=3),
                         st.lists).flatmap(add_bools))
     def test_nestedInteractions(self, values):
@@ -0,0 +1,116 @@
+"""
+Tests for the StaticFile DiscoverySource.
+"""
+
+from __future__ import absolute_import
+
+from unittest import TestCase
+from shutil import rmtree
+from tempfile import mkdtemp
+from json import dumps
+import os
+
+from .common import fake_runtime
+from mdk_discovery import Discovery
+from mdk_discovery.static_file import StaticFile
+
+from .test_discovery import knownNodes
+
+
+def encoded(service, address, environment="staging"):
+    """Return an encoded Node."""
+    return {"id": service + "/" + address, "service": service,
+            "version": "1.0", "address": address, "properties": {},
+            "environment": {"name": environment, "fallbackName": None}}
+
+
+class StaticFileTests(TestCase):
+    """Tests for StaticFile."""
+
+    def setUp(self):
+        self.runtime = fake_runtime()
+        self.disco = Discovery(self.runtime)
+        self.runtime.dispatcher.startActor(self.disco)
+
+        directory = mkdtemp()
+        self.addCleanup(lambda: rmtree(directory))
+        self.path = os.path.join(directory, "routes.json")
+
+    def start(self, chunkSize=500):
+        """Start the StaticFile source."""
+        self.source = StaticFile(self.path).create(self.disco, self.runtime)
+        self.source.chunkSize = chunkSize
+        self.runtime.dispatcher.startActor(self.source)
+
+    def pump(self):
+        """Deliver file-change events to the source."""
+        self.runtime.dispatcher.pump()
+        sched = self.runtime.getScheduleService()
+        sched.advance(1.0)
+        sched.pump()
+        self.runtime.dispatcher.pump()
+
+    def write(self, nodes):
+        """Write encoded Nodes to the routes file."""
+        with open(self.path, "w") as f:
+            f.write(dumps(nodes))
+
+    def addresses(self, service):
+        """Return the addresses Discovery knows for a service."""
+        return [n.address for n in knownNodes(self.disco, service, "staging")]
+
+    def test_manyServices(self):
+        """Nodes for all services in the file are added to Discovery."""
+        self.write([encoded("service1", "a:1"), encoded("service2", "b:1"),
+                    encoded("service1", "a:2")])
+        self.start()
+        self.pump()
+        self.assertEqual(self.addresses("service1"), ["a:1", "a:2"])
+        self.assertEqual(self.addresses("service2"), ["b:1"])
+
+    def test_chunked(self):
+        """Files larger than the chunk size are loaded completely."""
+        self.write([encoded("service%d" % (i % 3), "a:%d" % i)
+                    for i in range(10)])
+        self.start(chunkSize=2)
+        self.pump()
+        self.assertEqual(self.addresses("service0"), ["a:0", "a:3", "a:6", "a:9"])
+        self.assertEqual(self.addresses("service2"), ["a:2", "a:5", "a:8"])
+
+    def test_onlyChangedServices(self):
+        """When the file changes only services whose entries changed are replaced."""
+        self.write([encoded("service1", "a:1"), encoded("service2", "b:1")])
+        self.start()
+        self.pump()
+        unchanged = knownNodes(self.disco, "service2", "staging")[0]
+        self.write([encoded("service1", "a:3"), encoded("service2", "b:1")])
+        self.pump()
+        self.assertEqual(self.addresses("service1"), ["a:3"])
+        self.assertIs(knownNodes(self.disco, "service2", "staging")[0], unchanged)
+
+    def test_removedService(self):
+        """Services that are removed from the file are emptied."""
+        self.write([encoded("service1", "a:1"), encoded("service2", "b:1")])
+        self.start()
+        self.pump()
+        self.write([encoded("service1", "a:1")])
+        self.pump()
+        self.assertEqual(self.addresses("service2"), [])
+
+    def test_badFormat(self):
+        """An unreadable file leaves Discovery unchanged."""
+        self.write([encoded("service1", "a:1")])
+        self.start()
+        self.pump()
+        with open(self.path, "w") as f:
+            f.write("this is not json")
+        self.pump()
+        self.assertEqual(self.addresses("service1"), ["a:1"])
+
+    def test_syncedWithoutFile(self):
+        """If there is no file, the source is synced with no Nodes."""
+        self.start()
+        self.pump()
+        self.assertFalse(self.disco._synced)
+        self.pump()
+        self.assertTrue(self.disco._synced)
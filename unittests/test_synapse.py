@@ -10,14 +10,32 @@ from tempfile import mkdtemp
 from json import dumps
 from uuid import uuid4
 import os
+from time import time
 
 from .common import fake_runtime
 from mdk_protocol import OperationalEnvironment
 from mdk_discovery import Discovery, Node
 from mdk_discovery.synapse import Synapse
+from mdk_runtime.files import IOExecutor
+import mdk_runtime_files
+from mdk_runtime_files import _StatWatcher
 
 from .test_discovery import knownNodes
 
+class QueueingExecutor(IOExecutor):
+    """IOExecutor that only runs work when told to."""
+    def __init__(self):
+        self.work = []
+
+    def execute(self, work):
+        self.work.append(work)
+
+    def runAll(self):
+        work, self.work = self.work, []
+        for w in work:
+            w(None)
+
+
 class SynapseTests(TestCase):
     """Tests for Synapse."""
 
@@ -36,8 +54,7 @@ class SynapseTests(TestCase):
 
     def pump(self):
         """Deliver file-change events to Synapse."""
-        # Current implementation polls every second; later implementation may
-        # switch to inotify in which case this will have to change.
+        # Changes are checked for every second, via inotify where available.
         self.runtime.dispatcher.pump()
         sched = self.runtime.getScheduleService()
         sched.advance(1.0)
@@ -116,9 +133,153 @@ class SynapseTests(TestCase):
         self.pump()
         self.assertNodesEqual(knownNodes(self.disco, "service2", "staging"), [])
 
+    def test_notUTF8(self):
+        """A file that isn't valid UTF-8 is ignored, other files are still read."""
+        with open(os.path.join(self.directory, "service2.json"), "wb") as f:
+            f.write(b"\xff\xfe[]")
+        self.write("service1.json", [{"host": "host1", "port": 123}])
+        self.pump()
+        self.assertNodesEqual(knownNodes(self.disco, "service1", "staging"),
+                              [self.node("service1", "host1", 123)])
+
+    def test_scanFailure(self):
+        """A scan that fails doesn't stop later scans."""
+        def fail(path):
+            raise OSError("listing failed")
+        original = mdk_runtime_files._mdk_file_contents
+        mdk_runtime_files._mdk_file_contents = fail
+        try:
+            self.pump()
+        finally:
+            mdk_runtime_files._mdk_file_contents = original
+        self.write("service1.json", [{"host": "host1", "port": 123}])
+        self.pump()
+        self.assertNodesEqual(knownNodes(self.disco, "service1", "staging"),
+                              [self.node("service1", "host1", 123)])
+
     def test_unexpectedFilename(self):
         """Files that don't end with '.json' are ignored."""
         self.write("service1.abcd", [{"host": "host1", "port": 123},
                                      {"host": "host2", "port": 124}])
         self.pump()
         self.assertNodesEqual(knownNodes(self.disco, "service1", "staging"), [])
+
+    def test_unchangedFile(self):
+        """A file whose contents haven't changed doesn't update Discovery."""
+        self.write("service1.json", [{"host": "host1", "port": 123}])
+        self.pump()
+        before = knownNodes(self.disco, "service1", "staging")
+        self.pump()
+        after = knownNodes(self.disco, "service1", "staging")
+        self.assertEqual([id(n) for n in before], [id(n) for n in after])
+
+    def test_deterministicIds(self):
+        """Nodes have ids derived from the service, host and port."""
+        self.write("service1.json", [{"host": "host1", "port": 123},
+                                     {"host": "host2", "port": 124}])
+        self.pump()
+        self.assertEqual(
+            [n.id for n in knownNodes(self.disco, "service1", "staging")],
+            ["service1/host1:123", "service1/host2:124"])
+
+    def test_unchangedEntriesReused(self):
+        """
+        When a file changes, Nodes for unchanged entries are reused rather than
+        replaced.
+        """
+        self.write("service1.json", [{"host": "host1", "port": 123},
+                                     {"host": "host2", "port": 124}])
+        self.pump()
+        [first, _] = knownNodes(self.disco, "service1", "staging")
+        self.write("service1.json", [{"host": "host1", "port": 123},
+                                     {"host": "host3", "port": 125}])
+        self.pump()
+        nodes = knownNodes(self.disco, "service1", "staging")
+        self.assertIs(nodes[0], first)
+        self.assertEqual([n.address for n in nodes], ["host1:123", "host3:125"])
+
+    def test_scanInExecutor(self):
+        """
+        Files are scanned by the FileActor's IOExecutor, with at most one scan
+        outstanding per subscription.
+        """
+        executor = QueueingExecutor()
+        self.runtime.getFileService().withExecutor(executor)
+        self.write("service1.json", [{"host": "host1", "port": 123}])
+        self.pump()
+        self.pump()
+        self.assertEqual(len(executor.work), 1)
+        self.assertNodesEqual(knownNodes(self.disco, "service1", "staging"), [])
+
+        executor.runAll()
+        self.runtime.dispatcher.pump()
+        self.assertNodesEqual(knownNodes(self.disco, "service1", "staging"),
+                              [self.node("service1", "host1", 123)])
+        self.pump()
+        self.assertEqual(len(executor.work), 1)
+
+
+class StatWatcherTests(TestCase):
+    """Tests for _StatWatcher, the fallback file change detector."""
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.addCleanup(lambda: rmtree(self.directory, ignore_errors=True))
+        self.listings = 0
+        original = mdk_runtime_files._mdk_file_contents
+        def contents(path):
+            self.listings += 1
+            return original(path)
+        mdk_runtime_files._mdk_file_contents = contents
+        self.addCleanup(setattr, mdk_runtime_files, "_mdk_file_contents",
+                        original)
+
+    def create(self, name, directory=None):
+        """Create a file in the directory, returning its path."""
+        path = os.path.join(directory or self.directory, name)
+        with open(path, "w") as f:
+            f.write("[]")
+        return path
+
+    def test_unchangedDirectory(self):
+        """
+        If the directory's modification time is unchanged and old enough, it
+        isn't listed again.
+        """
+        path = self.create("a.json")
+        old = time() - 60
+        os.utime(self.directory, (old, old))
+        watcher = _StatWatcher(self.directory)
+        self.assertEqual(watcher.changed(), [path])
+        self.assertEqual((watcher.changed(), self.listings), ([], 1))
+
+    def test_racyChange(self):
+        """
+        A change within the same modification time tick as a recent listing
+        is still noticed.
+        """
+        self.create("a.json")
+        watcher = _StatWatcher(self.directory)
+        watcher.changed()
+        mtime = os.stat(self.directory).st_mtime
+        path = self.create("b.json")
+        os.utime(self.directory, (mtime, mtime))
+        self.assertEqual(watcher.changed(), [path])
+        self.assertEqual(self.listings, 2)
+
+    def test_directoryReplaced(self):
+        """
+        A directory replaced by another with the same modification time is
+        noticed by its inode.
+        """
+        old_path = self.create("a.json")
+        old = time() - 60
+        os.utime(self.directory, (old, old))
+        watcher = _StatWatcher(self.directory)
+        watcher.changed()
+        os.rename(self.directory, self.directory + ".old")
+        self.addCleanup(rmtree, self.directory + ".old")
+        os.mkdir(self.directory)
+        new_path = self.create("b.json")
+        os.utime(self.directory, (old, old))
+        self.assertEqual(sorted(watcher.changed()), [old_path, new_path])
@@ -5,7 +5,7 @@ Tests for utilities.
 from hypothesis import strategies as st
 from hypothesis import given, assume
 
-from mdk_util import versionMatch
+from mdk_util import versionMatch, Version
 
 
 positive_ints = st.integers(min_value=0, max_value=10000)
@@ -68,3 +68,24 @@ def test_patchIgnored(version):
     assert match(version, version[:2] + (0,))
     assert match(version[:2] + (0,), version)
 
+
+
+@given(major_minor_patch)
+def test_parseInterned(version):
+    """
+    Parsing the same string twice returns the same Version.
+    """
+    text = _join(version)
+    parsed = Version.parse(text)
+    assert parsed is Version.parse(text)
+    assert (parsed.major, parsed.minor) == version[:2]
+
+
+@given(major_minor, major_minor)
+def test_versionMatchesVersionMatch(version1, version2):
+    """
+    Version.matches() gives the same result as versionMatch().
+    """
+    requested, actual = _join(version1), _join(version2)
+    result = Version.parse(requested).matches(Version.parse(actual))
+    assert result == match(version1, version2)